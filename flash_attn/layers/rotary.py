@@ -144,14 +144,11 @@ class ApplyRotaryEmbQKV_(torch.autograd.Function):
     ):
         # batch, seqlen, three, nheads, headdim = qkv.shape
         assert qkv.shape[-3] == 3
-        if cos_k is None and sin_k is None and qkv.is_contiguous():
-            # Call 1 kernel instead of 2 kernels
-            # We need qkv to be contiguous so that when we reshape to combine (3, nheads)
-            # dimensions, we get the same tensor
-            qk = rearrange(qkv[..., :2, :, :], "... t h d -> ... (t h) d")
-            # qk = qkv[:, :, :2].reshape(batch, seqlen, -1, headdim)
+        if cos_k is None and sin_k is None:
+            # Call 1 kernel instead of 2 kernels: Q and K share cos / sin, and the kernel
+            # indexes the (2, nheads) dimensions with strides, so qkv need not be contiguous.
             apply_rotary(
-                qk,
+                qkv[..., :2, :, :],
                 cos,
                 sin,
                 seqlen_offsets=seqlen_offsets,
@@ -202,13 +199,10 @@ class ApplyRotaryEmbQKV_(torch.autograd.Function):
             cos, sin, cos_k, sin_k, cu_seqlens, seqlen_offsets = ctx.saved_tensors
         else:
             cos, sin, cos_k, sin_k, cu_seqlens = ctx.saved_tensors
-        if cos_k is None and sin_k is None and dqkv.is_contiguous():
+        if cos_k is None and sin_k is None:
             # Call 1 kernel instead of 2 kernels
-            # We need dqkv to be contiguous so that when we reshape to combine (3, nheads)
-            # dimensions, we get the same tensor
-            dqk = rearrange(dqkv[..., :2, :, :], "... t h d -> ... (t h) d")
             apply_rotary(
-                dqk,
+                dqkv[..., :2, :, :],
                 cos,
                 sin,
                 seqlen_offsets=seqlen_offsets,
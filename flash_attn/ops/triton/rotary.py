@@ -36,10 +36,14 @@ def rotary_kernel(
     stride_out_seqlen,
     stride_out_nheads,
     stride_out_headdim,
+    stride_out_qk,
     stride_x_batch,
     stride_x_seqlen,
     stride_x_nheads,
     stride_x_headdim,
+    stride_x_qk,
+    stride_cs_seqlen,
+    stride_cs_headdim,
     # Meta-parameters
     BLOCK_K: tl.constexpr,
     IS_SEQLEN_OFFSETS_TENSOR: tl.constexpr,
@@ -52,6 +56,12 @@ def rotary_kernel(
     pid_batch = tl.program_id(axis=1)
     pid_head = tl.program_id(axis=2)
     rotary_dim_half = rotary_dim // 2
+    # When Q and K are rotated in the same launch, heads [0, nheads) belong to Q and
+    # heads [nheads, 2 * nheads) belong to K, which starts stride_qk elements after Q.
+    pid_qk = pid_head // nheads
+    pid_head = pid_head % nheads
+    X = X + pid_qk * stride_x_qk
+    OUT = OUT + pid_qk * stride_out_qk
 
     if not IS_VARLEN:
         X = X + pid_batch * stride_x_batch + pid_head * stride_x_nheads
@@ -75,8 +85,8 @@ def rotary_kernel(
     if not INTERLEAVED:
         # Load the 1st and 2nd halves of X, do calculation, then store to 1st and 2nd halves of OUT
         X = X + (rm[:, None] * stride_x_seqlen + rk_half[None, :] * stride_x_headdim)
-        COS = COS + (rm_cs[:, None] * rotary_dim_half + rk_half[None, :])
-        SIN = SIN + (rm_cs[:, None] * rotary_dim_half + rk_half[None, :])
+        COS = COS + (rm_cs[:, None] * stride_cs_seqlen + rk_half[None, :] * stride_cs_headdim)
+        SIN = SIN + (rm_cs[:, None] * stride_cs_seqlen + rk_half[None, :] * stride_cs_headdim)
         cos = tl.load(
             COS, mask=(rm_cs[:, None] < seqlen_ro) & (rk_half[None, :] < rotary_dim_half), other=1.0
         ).to(tl.float32)
@@ -114,8 +124,8 @@ def rotary_kernel(
         rk_repeat = tl.arange(0, BLOCK_K) // 2
         X0 = X + (rm[:, None] * stride_x_seqlen + rk[None, :] * stride_x_headdim)
         X1 = X + (rm[:, None] * stride_x_seqlen + rk_swap[None, :] * stride_x_headdim)
-        COS = COS + (rm_cs[:, None] * rotary_dim_half + rk_repeat[None, :])
-        SIN = SIN + (rm_cs[:, None] * rotary_dim_half + rk_repeat[None, :])
+        COS = COS + (rm_cs[:, None] * stride_cs_seqlen + rk_repeat[None, :] * stride_cs_headdim)
+        SIN = SIN + (rm_cs[:, None] * stride_cs_seqlen + rk_repeat[None, :] * stride_cs_headdim)
         cos = tl.load(
             COS,
             mask=(rm_cs[:, None] < seqlen_ro) & (rk_repeat[None, :] < rotary_dim_half),
@@ -156,20 +166,28 @@ def apply_rotary(
     Arguments:
         x: (batch, seqlen, nheads, headdim) if cu_seqlens is None
             else (total_seqlen, nheads, headdim).
+            Can also be (batch, seqlen, 2, nheads, headdim) if cu_seqlens is None
+            else (total_seqlen, 2, nheads, headdim), in which case Q and K (e.g. a slice of
+            packed qkv, which need not be contiguous) are rotated in a single kernel launch.
         cos: (seqlen_ro, rotary_dim / 2)
         sin: (seqlen_ro, rotary_dim / 2)
+            cos and sin may be strided views; they are only made contiguous if their strides
+            differ.
         seqlen_offsets: integer or integer tensor of size (batch,)
         cu_seqlens: (batch + 1,) or None
         max_seqlen: int
     Returns:
-        y: (batch, seqlen, nheads, headdim)
+        y: same shape as x
     """
     is_varlen = cu_seqlens is not None
+    is_qk = x.dim() == (4 if is_varlen else 5)
+    if is_qk:
+        assert x.shape[-3] == 2, "If x has a qk dimension, it must be of size 2"
     if not is_varlen:
-        batch, seqlen, nheads, headdim = x.shape
+        batch, seqlen, *_, nheads, headdim = x.shape
     else:
         assert max_seqlen is not None, "If cu_seqlens is passed in, then max_seqlen must be passed"
-        total_seqlen, nheads, headdim = x.shape
+        total_seqlen, *_, nheads, headdim = x.shape
         batch_p_1 = cu_seqlens.shape[0]
         batch = batch_p_1 - 1
         seqlen = max_seqlen
@@ -187,7 +205,8 @@ def apply_rotary(
         x.dtype == cos.dtype
     ), f"Input and cos/sin must have the same dtype, got {x.dtype} and {cos.dtype}"
 
-    cos, sin = cos.contiguous(), sin.contiguous()
+    if cos.stride() != sin.stride():
+        cos, sin = cos.contiguous(), sin.contiguous()
     if isinstance(seqlen_offsets, torch.Tensor):
         assert seqlen_offsets.shape == (batch,)
         assert seqlen_offsets.dtype in [torch.int32, torch.int64]
@@ -204,8 +223,13 @@ def apply_rotary(
         if rotary_dim <= 32
         else (64 if rotary_dim <= 64 else (128 if rotary_dim <= 128 else 256))
     )
-    grid = lambda META: (triton.cdiv(seqlen, META["BLOCK_M"]), batch, nheads)  # noqa
+    grid = lambda META: (  # noqa
+        triton.cdiv(seqlen, META["BLOCK_M"]),
+        batch,
+        nheads * (2 if is_qk else 1),
+    )
     BLOCK_M = 4 if interleaved else (8 if rotary_dim <= 64 else 4)
+    seqlen_dim = 0 if is_varlen else 1
 
     # Need this, otherwise Triton tries to launch from cuda:0 and we get
     # ValueError: Pointer argument (at 0) cannot be accessed from Triton (cpu tensor?)
@@ -223,13 +247,17 @@ def apply_rotary(
             seqlen_ro,
             seqlen // 128,  # key for triton cache (limit number of compilations)
             output.stride(0) if not is_varlen else 0,  # batch_strides if not varlen else 0
-            output.stride(-3),  # seqlen_stride or total_seqlen_stride
+            output.stride(seqlen_dim),  # seqlen_stride or total_seqlen_stride
             output.stride(-2),  # nheads_stride
             output.stride(-1),  # headdim_stride
+            output.stride(-3) if is_qk else 0,  # qk_stride if Q and K are rotated together
             x.stride(0) if not is_varlen else 0,  # batch_strides if not varlen else 0
-            x.stride(-3),  # seqlen stride or total_seqlen_stride
+            x.stride(seqlen_dim),  # seqlen stride or total_seqlen_stride
             x.stride(-2),  # nheads stride
             x.stride(-1),  # headdim stride
+            x.stride(-3) if is_qk else 0,  # qk stride if Q and K are rotated together
+            cos.stride(0),  # cos / sin seqlen stride
+            cos.stride(1),  # cos / sin headdim stride
             BLOCK_K,
             isinstance(seqlen_offsets, torch.Tensor),
             is_varlen,
@@ -1,5 +1,6 @@
 # Copyright (c) 2023, Tri Dao.
 
+import functools
 import math
 
 import pytest
@@ -7,28 +8,142 @@ import torch
 import torch.nn.functional as F
 from einops import rearrange
 from flash_attn.layers.rotary import RotaryEmbedding, apply_rotary_emb_func, apply_rotary_emb_qkv_
-from flash_attn.bert_padding import unpad_input, pad_input
+from flash_attn.bert_padding import index_first_axis, pad_input
+
+
+class DeviceChecks:
+    """Collects closeness / equality checks as bool scalars on device, and syncs once when
+    check() is called at the end of the test instead of once per assert."""
+
+    def __init__(self):
+        self._labels = []
+        self._oks = []
+        self._values = []
+
+    def _add(self, label, ok, value):
+        self._labels.append(label)
+        self._oks.append(ok)
+        self._values.append(value.float())
+
+    def close(self, label, a, b, rtol=1e-5, atol=1e-8):
+        # Same check as torch.allclose(a, b, rtol, atol), i.e. |a - b| <= atol + rtol * |b|.
+        # Reports the max of |a - b| - (atol + rtol * |b|) on failure.
+        if a.numel() == 0 and b.numel() == 0:
+            return
+        with torch.no_grad():
+            violation = (a - b).abs_().sub_(b.abs().mul_(rtol).add_(atol)).amax()
+            self._add(label, violation <= 0, violation)
+
+    def equal(self, label, a, b):
+        # Same check as torch.equal(a, b). Reports the max of |a - b| on failure.
+        if a.shape != b.shape:
+            nan = torch.full((), float("nan"), device=a.device)
+            self._add(f"{label} (shape {tuple(a.shape)} != {tuple(b.shape)})", nan == 0, nan)
+            return
+        if a.numel() == 0:
+            return
+        with torch.no_grad():
+            self._add(label, (a == b).all(), (a.float() - b.float()).abs_().amax())
+
+    def check(self):
+        if not self._oks:
+            return
+        oks, values = torch.stack(
+            [torch.stack(self._oks).float(), torch.stack(self._values)]
+        ).tolist()
+        failed = [
+            f"{label}: {value:.3g}"
+            for label, ok, value in zip(self._labels, oks, values)
+            if not ok
+        ]
+        assert not failed, "Checks failed (label: max violation): " + ", ".join(failed)
+
+
+@functools.lru_cache(maxsize=None)
+def _make_rotary(rotary_dim, interleaved=False, scale_type=None, scale_factor=None, device="cuda"):
+    # The cos / sin cache only grows and is rebuilt on dtype / device change, and forward doesn't
+    # modify it, so the same instance can be shared across parametrized cases.
+    return RotaryEmbedding(
+        rotary_dim,
+        interleaved=interleaved,
+        scale_factor=scale_factor,
+        scale_type=scale_type,
+        device=device,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _sincos_positions(seqlen, rotary_dim, device, dtype):
+    # HF's GPT-J sin / cos table only depends on (seqlen, rotary_dim). Callers must not modify it.
+    from transformers.models.gptj.modeling_gptj import create_sinusoidal_positions
+
+    return create_sinusoidal_positions(seqlen, rotary_dim).to(device=device, dtype=dtype)
+
+
+def _rotate_neox(x, cos, sin):
+    # Same math as HF's x * cos + rotate_half(x) * sin, but both halves are written into a
+    # single output instead of materializing rotate_half(x) with torch.cat.
+    d = x.shape[-1] // 2
+    x1, x2 = x[..., :d], x[..., d:]
+    out = torch.empty_like(x)
+    out[..., :d].copy_(x1 * cos[..., :d] - x2 * sin[..., :d])
+    out[..., d:].copy_(x1 * sin[..., d:] + x2 * cos[..., d:])
+    return out
+
+
+def apply_rotary_pos_emb_ref(q, k, cos, sin, position_ids, unsqueeze_dim=1):
+    """Drop-in for apply_rotary_pos_emb from HF's GPT-NeoX / Llama modeling code."""
+    cos = cos[position_ids].unsqueeze(unsqueeze_dim)
+    sin = sin[position_ids].unsqueeze(unsqueeze_dim)
+    return _rotate_neox(q, cos, sin), _rotate_neox(k, cos, sin)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _clear_module_caches():
+    # The lru_cache'd helpers above hold CUDA tensors, don't keep them alive past this module
+    yield
+    _make_rotary.cache_clear()
+    _sincos_positions.cache_clear()
+
+
+@pytest.fixture(scope="module")
+def qkv_buffer():
+    # Shared by the tests that use (8, <= 2048, 3, 16, 128) fp16 qkv, each of which refills the
+    # slice it needs. Slicing along seqlen gives non-contiguous qkv, which the rotary kernel
+    # handles through strides.
+    return torch.empty(8, 2048, 3, 16, 128, device="cuda", dtype=torch.float16)
+
+
+@pytest.fixture(scope="module")
+def varlen_layout():
+    # (max_seqlen_qkv, max_seqlen_offset, batch_size) -> (seqlen_offset, indices, cu_seqlens,
+    # max_seqlen) for test_rotary_varlen, shared by the cases that only differ in heads / dims
+    return {}
+
+
+@pytest.fixture(scope="session")
+def hf_cos_sin_cache():
+    # (rotary_type, rotary_dim, scaling_type, scaling_factor) -> (cos, sin) from the HF rotary
+    # module. These only depend on the key, not on seqlen_offset or the random inputs.
+    return {}
 
 
 # NeoX-style rotary embedding
+# rotary_emb_fraction = 0.0 (rotary_dim = 0) is covered by test_rotary_zero_dim_passthrough
 @pytest.mark.parametrize("seqlen_offset", [0, 128, 711, 2047])
-@pytest.mark.parametrize("rotary_emb_fraction", [0.0, 0.5, 1.0])
+@pytest.mark.parametrize("rotary_emb_fraction", [0.5, 1.0])
 @pytest.mark.parametrize("rotary_type", ["gpt-neox", "llama"])
-def test_rotary_neox(rotary_emb_fraction, seqlen_offset, rotary_type):
+def test_rotary_neox(
+    rotary_emb_fraction, seqlen_offset, rotary_type, hf_cos_sin_cache, qkv_buffer
+):
     if rotary_type == "gpt-neox":
         from transformers.models.gpt_neox.modeling_gpt_neox import (
             GPTNeoXRotaryEmbedding as RotaryEmbeddingHF,
         )
-        from transformers.models.gpt_neox.modeling_gpt_neox import (
-            apply_rotary_pos_emb as apply_rotary_pos_emb_hf,
-        )
     elif rotary_type == "llama":
         from transformers.models.llama.modeling_llama import (
             LlamaRotaryEmbedding as RotaryEmbeddingHF,
         )
-        from transformers.models.llama.modeling_llama import (
-            apply_rotary_pos_emb as apply_rotary_pos_emb_hf,
-        )
 
     device = "cuda"
     dtype = torch.float16
@@ -42,75 +157,155 @@ def test_rotary_neox(rotary_emb_fraction, seqlen_offset, rotary_type):
     nheads = 16
     headdim = 128
     rotary_dim = int(headdim * rotary_emb_fraction)
-    qkv = torch.randn(
-        batch_size, seqlen, 3, nheads, headdim, device=device, dtype=dtype, requires_grad=True
-    )
-    qkv_og = qkv.clone().detach()  # Our implementation modifies qkv inplace
-    rotary = RotaryEmbedding(rotary_dim, device=device)
-    rotary_neox = RotaryEmbeddingHF(rotary_dim, seqlen_total, device=device)
-    # Doesn't matter what tensor we pass in, rotary_neox only uses the device of the tensor
-    cos_neox, sin_neox = rotary_neox(qkv, seq_len=seqlen_total)
-    cos_neox, sin_neox = cos_neox.to(dtype=dtype), sin_neox.to(dtype=dtype)
-    q_pt = (
-        rearrange(qkv[:, :, 0, :, :rotary_dim], "b s h d -> b h s d")
+    qkv = (
+        qkv_buffer[:batch_size, :seqlen, :, :nheads, :headdim]
         .detach()
-        .clone()
-        .requires_grad_(True)
+        .normal_(generator=torch.Generator(device=device).manual_seed(0))
+        .requires_grad_()
     )
-    k_pt = (
-        rearrange(qkv[:, :, 1, :, :rotary_dim], "b s h d -> b h s d")
-        .detach()
-        .clone()
-        .requires_grad_(True)
-    )
-    q_neox, k_neox = apply_rotary_pos_emb_hf(
+    qkv_og = qkv.clone().detach()  # Our implementation modifies qkv inplace
+    rotary = _make_rotary(rotary_dim, device=device)
+    key = (rotary_type, rotary_dim, None, None)
+    if key not in hf_cos_sin_cache:
+        rotary_neox = RotaryEmbeddingHF(rotary_dim, seqlen_total, device=device)
+        # Doesn't matter what tensor we pass in, rotary_neox only uses the device of the tensor
+        cos_neox, sin_neox = rotary_neox(qkv, seq_len=seqlen_total)
+        hf_cos_sin_cache[key] = (cos_neox.to(dtype=dtype), sin_neox.to(dtype=dtype))
+    cos_neox, sin_neox = hf_cos_sin_cache[key]
+    q_pt = qkv[:, :, 0, :, :rotary_dim].transpose(1, 2).detach().clone().requires_grad_(True)
+    k_pt = qkv[:, :, 1, :, :rotary_dim].transpose(1, 2).detach().clone().requires_grad_(True)
+    q_neox, k_neox = apply_rotary_pos_emb_ref(
         q_pt, k_pt, cos_neox, sin_neox, position_ids, unsqueeze_dim=0
     )
     out = rotary(qkv, seqlen_offset=seqlen_offset)
-    assert torch.allclose(
-        rotary._cos_cached, cos_neox[..., : rotary_dim // 2].to(dtype=dtype), rtol=rtol, atol=atol
-    )
-    assert torch.allclose(
-        rotary._sin_cached, sin_neox[..., : rotary_dim // 2].to(dtype=dtype), rtol=rtol, atol=atol
+    checks = DeviceChecks()
+    checks.close(
+        "cos",
+        rotary._cos_cached[:seqlen_total],
+        cos_neox[..., : rotary_dim // 2].to(dtype=dtype),
+        rtol=rtol,
+        atol=atol,
     )
-    assert torch.allclose(
-        rearrange(q_neox, "b h s d -> b s h d"), out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol
+    checks.close(
+        "sin",
+        rotary._sin_cached[:seqlen_total],
+        sin_neox[..., : rotary_dim // 2].to(dtype=dtype),
+        rtol=rtol,
+        atol=atol,
     )
-    assert torch.allclose(
-        rearrange(k_neox, "b h s d -> b s h d"), out[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol
+    checks.close("q", q_neox.transpose(1, 2), out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.close("k", k_neox.transpose(1, 2), out[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.equal(
+        "qk pass-through", out[:, :, 0:2, :, rotary_dim:], qkv_og[:, :, 0:2, :, rotary_dim:]
     )
-    assert torch.equal(out[:, :, 0:2, :, rotary_dim:], qkv_og[:, :, 0:2, :, rotary_dim:])
-    assert torch.equal(out[:, :, 2], qkv_og[:, :, 2])
+    checks.equal("v", out[:, :, 2], qkv_og[:, :, 2])
 
     g = torch.randn_like(out)
     g_og = g.clone().detach()  # Our implementation modifies g inplace
     out.backward(g)
-    q_neox.backward(rearrange(g_og[:, :, 0, :, :rotary_dim], "b s h d -> b h s d"))
-    k_neox.backward(rearrange(g_og[:, :, 1, :, :rotary_dim], "b s h d -> b h s d"))
-    assert torch.allclose(
-        rearrange(q_pt.grad, "b h s d -> b s h d"),
+    q_neox.backward(g_og[:, :, 0, :, :rotary_dim].transpose(1, 2))
+    k_neox.backward(g_og[:, :, 1, :, :rotary_dim].transpose(1, 2))
+    checks.close(
+        "dq",
+        q_pt.grad.transpose(1, 2),
         qkv.grad[:, :, 0, :, :rotary_dim],
         rtol=rtol,
         atol=atol,
     )
-    assert torch.allclose(
-        rearrange(k_pt.grad, "b h s d -> b s h d"),
+    checks.close(
+        "dk",
+        k_pt.grad.transpose(1, 2),
         qkv.grad[:, :, 1, :, :rotary_dim],
         rtol=rtol,
         atol=atol,
     )
-    assert torch.equal(qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:])
-    assert torch.equal(qkv.grad[:, :, 2], g_og[:, :, 2])
+    checks.equal(
+        "dqk pass-through", qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:]
+    )
+    checks.equal("dv", qkv.grad[:, :, 2], g_og[:, :, 2])
+    checks.check()
+
+
+def test_rotary_zero_dim_passthrough():
+    # With rotary_dim = 0 the rotary embedding is the identity on qkv and on its gradient
+    device = "cuda"
+    dtype = torch.float16
+    # set seed
+    torch.random.manual_seed(0)
+    qkv = torch.randn(2, 128, 3, 4, 64, device=device, dtype=dtype, requires_grad=True)
+    qkv_og = qkv.clone().detach()
+    rotary = _make_rotary(0, device=device)
+    out = rotary(qkv, seqlen_offset=17)
+    assert torch.equal(out, qkv_og)
+    g = torch.randn_like(out)
+    g_og = g.clone().detach()
+    out.backward(g)
+    assert torch.equal(qkv.grad, g_og)
+
+
+@pytest.mark.parametrize("interleaved", [False, True])
+def test_rotary_kvcache_cos_sin(interleaved):
+    # MHA's decoding fast path passes _cos_cached / _sin_cached to flash_attn_with_kvcache, which
+    # requires contiguous tables. Check that they are, and that rotating inside the kvcache kernel
+    # matches rotating q / k with the Triton kernel beforehand.
+    from flash_attn import flash_attn_with_kvcache
+
+    device = "cuda"
+    dtype = torch.float16
+    rtol, atol = (1e-3, 5e-3)
+    # set seed
+    torch.random.manual_seed(0)
+    batch_size = 2
+    seqlen_cache = 128
+    nheads = 4
+    headdim = 64
+    rotary_dim = 32
+    rotary = RotaryEmbedding(rotary_dim, interleaved=interleaved, device=device)
+    rotary._update_cos_sin_cache(seqlen_cache + 1, device=device, dtype=dtype)
+    assert rotary._cos_cached.is_contiguous() and rotary._sin_cached.is_contiguous()
+
+    q = torch.randn(batch_size, 1, nheads, headdim, device=device, dtype=dtype)
+    kv = torch.randn(batch_size, 1, 2, nheads, headdim, device=device, dtype=dtype)
+    kv_cache = torch.randn(
+        batch_size, seqlen_cache + 1, 2, nheads, headdim, device=device, dtype=dtype
+    )
+    cache_seqlens = torch.full((batch_size,), seqlen_cache, device=device, dtype=torch.int32)
+
+    kv_cache_ro = kv_cache.clone()
+    out = flash_attn_with_kvcache(
+        q,
+        kv_cache_ro[:, :, 0],
+        kv_cache_ro[:, :, 1],
+        kv[:, :, 0],
+        kv[:, :, 1],
+        rotary_cos=rotary._cos_cached,
+        rotary_sin=rotary._sin_cached,
+        cache_seqlens=cache_seqlens,
+        causal=True,
+        rotary_interleaved=interleaved,
+    )
+    q_ref, kv_ref = rotary(q.clone(), kv.clone(), seqlen_offset=seqlen_cache)
+    kv_cache_ref = kv_cache.clone()
+    out_ref = flash_attn_with_kvcache(
+        q_ref,
+        kv_cache_ref[:, :, 0],
+        kv_cache_ref[:, :, 1],
+        kv_ref[:, :, 0],
+        kv_ref[:, :, 1],
+        cache_seqlens=cache_seqlens,
+        causal=True,
+    )
+    assert torch.allclose(kv_cache_ro, kv_cache_ref, rtol=rtol, atol=atol)
+    assert torch.allclose(out, out_ref, rtol=rtol, atol=atol)
 
 
 # GPT-J-style rotary embedding
 @pytest.mark.parametrize("seqlen_offset", [0, 711])
 @pytest.mark.parametrize("rotary_emb_fraction", [0.5, 1.0])
-def test_rotary_gptj_interleaved(rotary_emb_fraction, seqlen_offset):
+def test_rotary_gptj_interleaved(rotary_emb_fraction, seqlen_offset, qkv_buffer):
     from transformers.models.gptj.modeling_gptj import (
         apply_rotary_pos_emb as apply_rotary_pos_emb_gptj,
     )
-    from transformers.models.gptj.modeling_gptj import create_sinusoidal_positions
 
     device = "cuda"
     dtype = torch.float16
@@ -123,18 +318,19 @@ def test_rotary_gptj_interleaved(rotary_emb_fraction, seqlen_offset):
     nheads = 16
     headdim = 128
     rotary_dim = int(headdim * rotary_emb_fraction)
-    qkv = torch.randn(
-        batch_size, seqlen, 3, nheads, headdim, device=device, dtype=dtype, requires_grad=True
+    qkv = (
+        qkv_buffer[:batch_size, :seqlen, :, :nheads, :headdim]
+        .detach()
+        .normal_(generator=torch.Generator(device=device).manual_seed(0))
+        .requires_grad_()
     )
     qkv_og = qkv.clone().detach()  # Our implementation modifies qkv inplace
-    rotary = RotaryEmbedding(rotary_dim, interleaved=True, device=device)
+    rotary = _make_rotary(rotary_dim, interleaved=True, device=device)
     position_ids = torch.arange(
         seqlen_offset, seqlen_total, device=device, dtype=torch.long
     ).unsqueeze(0)
-    embed_positions = (
-        create_sinusoidal_positions(seqlen_total, rotary_dim)
-        .repeat(position_ids.shape[0], 1, 1)
-        .to(device=device, dtype=dtype)
+    embed_positions = _sincos_positions(seqlen_total, rotary_dim, device, dtype).repeat(
+        position_ids.shape[0], 1, 1
     )
     repeated_position_ids = position_ids.unsqueeze(-1).repeat(1, 1, embed_positions.shape[-1])
     sincos = torch.gather(embed_positions, 1, repeated_position_ids)
@@ -145,22 +341,32 @@ def test_rotary_gptj_interleaved(rotary_emb_fraction, seqlen_offset):
     k_gptj = apply_rotary_pos_emb_gptj(k_pt, sin_gptj, cos_gptj)
 
     out = rotary(qkv, seqlen_offset=seqlen_offset)
-    assert torch.allclose(rotary._cos_cached[seqlen_offset:], cos_gptj, rtol=rtol, atol=atol)
-    assert torch.allclose(rotary._sin_cached[seqlen_offset:], sin_gptj, rtol=rtol, atol=atol)
-    assert torch.allclose(q_gptj, out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol)
-    assert torch.allclose(k_gptj, out[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
-    assert torch.equal(out[:, :, 0:2, :, rotary_dim:], qkv_og[:, :, 0:2, :, rotary_dim:])
-    assert torch.equal(out[:, :, 2], qkv_og[:, :, 2])
+    checks = DeviceChecks()
+    checks.close(
+        "cos", rotary._cos_cached[seqlen_offset:seqlen_total], cos_gptj, rtol=rtol, atol=atol
+    )
+    checks.close(
+        "sin", rotary._sin_cached[seqlen_offset:seqlen_total], sin_gptj, rtol=rtol, atol=atol
+    )
+    checks.close("q", q_gptj, out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.close("k", k_gptj, out[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.equal(
+        "qk pass-through", out[:, :, 0:2, :, rotary_dim:], qkv_og[:, :, 0:2, :, rotary_dim:]
+    )
+    checks.equal("v", out[:, :, 2], qkv_og[:, :, 2])
 
     g = torch.randn_like(out)
     g_og = g.clone().detach()  # Our implementation modifies g inplace
     out.backward(g)
     q_gptj.backward(g_og[:, :, 0, :, :rotary_dim])
     k_gptj.backward(g_og[:, :, 1, :, :rotary_dim])
-    assert torch.allclose(q_pt.grad, qkv.grad[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol)
-    assert torch.allclose(k_pt.grad, qkv.grad[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
-    assert torch.equal(qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:])
-    assert torch.equal(qkv.grad[:, :, 2], g_og[:, :, 2])
+    checks.close("dq", q_pt.grad, qkv.grad[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.close("dk", k_pt.grad, qkv.grad[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.equal(
+        "dqk pass-through", qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:]
+    )
+    checks.equal("dv", qkv.grad[:, :, 2], g_og[:, :, 2])
+    checks.check()
 
 
 @pytest.mark.parametrize("max_seqlen_offset", [0, 10, 811])
@@ -179,6 +385,7 @@ def test_rotary_varlen(
     max_seqlen_offset,
     mha_type,
     nheads,
+    varlen_layout,
 ):
     device = "cuda"
     dtype = torch.float16
@@ -188,16 +395,36 @@ def test_rotary_varlen(
     batch_size = 8
     headdim = 128
     rotary_dim = int(headdim * rotary_emb_fraction)
-    if max_seqlen_offset > 0:
-        seqlen_offset = torch.randint(
-            0, max_seqlen_offset, (batch_size,), device=device, dtype=torch.long
+    key = (max_seqlen_qkv, max_seqlen_offset, batch_size)
+    if key not in varlen_layout:
+        # Draw the layout from its own generator so that the qkv drawn below from the global RNG
+        # doesn't depend on whether this case or an earlier one populated the cache
+        generator = torch.Generator(device=device).manual_seed(0)
+        if max_seqlen_offset > 0:
+            seqlen_offset = torch.randint(
+                0,
+                max_seqlen_offset,
+                (batch_size,),
+                generator=generator,
+                device=device,
+                dtype=torch.long,
+            )
+        else:
+            seqlen_offset = torch.zeros(batch_size, device=device, dtype=torch.long)
+        seqlens_q = torch.randint(
+            0, max_seqlen_qkv, (batch_size,), generator=generator, device=device, dtype=torch.long
         )
-    else:
-        seqlen_offset = torch.zeros(batch_size, device=device, dtype=torch.long)
-    seqlens_q = torch.randint(0, max_seqlen_qkv, (batch_size,), device=device, dtype=torch.long)
-    attention_mask = torch.arange(max_seqlen_qkv, device=device, dtype=torch.long).unsqueeze(
-        0
-    ) < seqlens_q.unsqueeze(1)
+        attention_mask = torch.arange(max_seqlen_qkv, device=device, dtype=torch.long).unsqueeze(
+            0
+        ) < seqlens_q.unsqueeze(1)
+        # Same indices / cu_seqlens / max_seqlen as unpad_input(x, attention_mask) would return,
+        # keep in sync with flash_attn.bert_padding.unpad_input
+        seqlens_in_batch = attention_mask.sum(dim=-1, dtype=torch.int32)
+        indices_q = torch.nonzero(attention_mask.flatten(), as_tuple=False).flatten()
+        max_seqlen_q = seqlens_in_batch.max().item()
+        cu_seqlens_q = F.pad(torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
+        varlen_layout[key] = (seqlen_offset, indices_q, cu_seqlens_q, max_seqlen_q)
+    seqlen_offset, indices_q, cu_seqlens_q, max_seqlen_q = varlen_layout[key]
     if mha_type == "mha":
         qkv = torch.randn(
             batch_size,
@@ -233,12 +460,17 @@ def test_rotary_varlen(
         )
         q, kv = qkv[:, :, :nheads], qkv[:, :, nheads:]
         kv = kv.view(batch_size, max_seqlen_qkv, 2, 4, headdim)
-    q_unpad, indices_q, cu_seqlens_q, max_seqlen_q = unpad_input(q, attention_mask)
-    kv_unpad, *_ = unpad_input(kv, attention_mask)
+
+    def unpad(x):
+        # Same as unpad_input(x, attention_mask)[0], with the cached indices
+        return index_first_axis(rearrange(x, "b s ... -> (b s) ..."), indices_q)
+
+    q_unpad = unpad(q)
+    kv_unpad = unpad(kv)
     kv_unpad_original = kv_unpad.clone().detach()
     q_unpad = q_unpad.clone().detach().requires_grad_()
     kv_unpad = kv_unpad.clone().detach().requires_grad_()
-    rotary = RotaryEmbedding(rotary_dim, device=device)
+    rotary = _make_rotary(rotary_dim, device=device)
     qout1_unpad, kvout1_unpad = rotary(
         q_unpad,
         kv_unpad,
@@ -248,39 +480,40 @@ def test_rotary_varlen(
     )
     q2, kv2 = q.clone().detach().requires_grad_(), kv.clone().detach().requires_grad_()
     qout2, kvout2 = rotary(q2, kv2, seqlen_offset=seqlen_offset)
-    qout2_unpad = unpad_input(qout2, attention_mask)[0]
-    kvout2_unpad = unpad_input(kvout2, attention_mask)[0]
-    assert torch.allclose(qout1_unpad, qout2_unpad)
-    assert torch.allclose(kvout1_unpad, kvout2_unpad)
-    assert torch.allclose(kvout2_unpad[:, 1], kv_unpad_original[:, 1])
+    qout2_unpad = unpad(qout2)
+    kvout2_unpad = unpad(kvout2)
+    checks = DeviceChecks()
+    checks.close("q", qout1_unpad, qout2_unpad)
+    checks.close("kv", kvout1_unpad, kvout2_unpad)
+    checks.close("v", kvout2_unpad[:, 1], kv_unpad_original[:, 1])
 
     g = torch.randn_like(qout1_unpad)
     gg = g.clone().detach()
     qout1_unpad.backward(g)
     qout2_unpad.backward(gg)
-    g2 = unpad_input(q2.grad, attention_mask)[0]
-    assert torch.allclose(g2, q_unpad.grad)
+    g2 = unpad(q2.grad)
+    checks.close("dq", g2, q_unpad.grad)
 
     g = torch.randn_like(kvout1_unpad)
     gg = g.clone().detach()
     kvout1_unpad.backward(g)
     kvout2_unpad.backward(gg)
-    g2 = unpad_input(kv2.grad, attention_mask)[0]
-    assert torch.allclose(g2, kv_unpad.grad)
+    g2 = unpad(kv2.grad)
+    checks.close("dkv", g2, kv_unpad.grad)
+    checks.check()
 
 
 @pytest.mark.parametrize("seqlen_offset", [0, 128, 711, 2047])
 @pytest.mark.parametrize("rotary_emb_fraction", [0.5, 1.0])
 @pytest.mark.parametrize("scaling_type", ["linear", "dynamic"])
 @pytest.mark.parametrize("scaling_factor", [1.0, 0.5, 2.0])
-def test_rotary_scaling(rotary_emb_fraction, seqlen_offset, scaling_type, scaling_factor):
+def test_rotary_scaling(
+    rotary_emb_fraction, seqlen_offset, scaling_type, scaling_factor, hf_cos_sin_cache, qkv_buffer
+):
     from transformers.models.llama.modeling_llama import (
         LlamaLinearScalingRotaryEmbedding,
         LlamaDynamicNTKScalingRotaryEmbedding,
     )
-    from transformers.models.llama.modeling_llama import (
-        apply_rotary_pos_emb as apply_rotary_pos_emb_hf,
-    )
 
     if scaling_type == "linear":
         RotaryEmbeddingHF = LlamaLinearScalingRotaryEmbedding
@@ -299,66 +532,74 @@ def test_rotary_scaling(rotary_emb_fraction, seqlen_offset, scaling_type, scalin
     nheads = 16
     headdim = 128
     rotary_dim = int(headdim * rotary_emb_fraction)
-    qkv = torch.randn(
-        batch_size, seqlen, 3, nheads, headdim, device=device, dtype=dtype, requires_grad=True
-    )
-    qkv_og = qkv.clone().detach()  # Our implementation modifies qkv inplace
-    rotary = RotaryEmbedding(
-        rotary_dim, scale_factor=scaling_factor, scale_type=scaling_type, device=device
-    )
-    rotary_neox = RotaryEmbeddingHF(
-        rotary_dim, seqlen_total, scaling_factor=scaling_factor, device=device
-    )
-    # Doesn't matter what tensor we pass in, rotary_neox only uses the device of the tensor
-    cos_neox, sin_neox = rotary_neox(qkv, seq_len=seqlen_total)
-    cos_neox, sin_neox = cos_neox.to(dtype=dtype), sin_neox.to(dtype=dtype)
-    q_pt = (
-        rearrange(qkv[:, :, 0, :, :rotary_dim], "b s h d -> b h s d")
+    qkv = (
+        qkv_buffer[:batch_size, :seqlen, :, :nheads, :headdim]
         .detach()
-        .clone()
-        .requires_grad_(True)
+        .normal_(generator=torch.Generator(device=device).manual_seed(0))
+        .requires_grad_()
     )
-    k_pt = (
-        rearrange(qkv[:, :, 1, :, :rotary_dim], "b s h d -> b h s d")
-        .detach()
-        .clone()
-        .requires_grad_(True)
+    qkv_og = qkv.clone().detach()  # Our implementation modifies qkv inplace
+    rotary = _make_rotary(
+        rotary_dim, scale_type=scaling_type, scale_factor=scaling_factor, device=device
     )
-    q_neox, k_neox = apply_rotary_pos_emb_hf(
+    key = ("llama", rotary_dim, scaling_type, scaling_factor)
+    if key not in hf_cos_sin_cache:
+        rotary_neox = RotaryEmbeddingHF(
+            rotary_dim, seqlen_total, scaling_factor=scaling_factor, device=device
+        )
+        # Doesn't matter what tensor we pass in, rotary_neox only uses the device of the tensor
+        cos_neox, sin_neox = rotary_neox(qkv, seq_len=seqlen_total)
+        hf_cos_sin_cache[key] = (cos_neox.to(dtype=dtype), sin_neox.to(dtype=dtype))
+    cos_neox, sin_neox = hf_cos_sin_cache[key]
+    q_pt = qkv[:, :, 0, :, :rotary_dim].transpose(1, 2).detach().clone().requires_grad_(True)
+    k_pt = qkv[:, :, 1, :, :rotary_dim].transpose(1, 2).detach().clone().requires_grad_(True)
+    q_neox, k_neox = apply_rotary_pos_emb_ref(
         q_pt, k_pt, cos_neox, sin_neox, position_ids, unsqueeze_dim=0
     )
     out = rotary(qkv, seqlen_offset=seqlen_offset)
-    assert torch.allclose(
-        rotary._cos_cached, cos_neox[..., : rotary_dim // 2].to(dtype=dtype), rtol=rtol, atol=atol
-    )
-    assert torch.allclose(
-        rotary._sin_cached, sin_neox[..., : rotary_dim // 2].to(dtype=dtype), rtol=rtol, atol=atol
+    checks = DeviceChecks()
+    checks.close(
+        "cos",
+        rotary._cos_cached[:seqlen_total],
+        cos_neox[..., : rotary_dim // 2].to(dtype=dtype),
+        rtol=rtol,
+        atol=atol,
     )
-    assert torch.allclose(
-        rearrange(q_neox, "b h s d -> b s h d"), out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol
+    checks.close(
+        "sin",
+        rotary._sin_cached[:seqlen_total],
+        sin_neox[..., : rotary_dim // 2].to(dtype=dtype),
+        rtol=rtol,
+        atol=atol,
     )
-    assert torch.allclose(
-        rearrange(k_neox, "b h s d -> b s h d"), out[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol
+    checks.close("q", q_neox.transpose(1, 2), out[:, :, 0, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.close("k", k_neox.transpose(1, 2), out[:, :, 1, :, :rotary_dim], rtol=rtol, atol=atol)
+    checks.equal(
+        "qk pass-through", out[:, :, 0:2, :, rotary_dim:], qkv_og[:, :, 0:2, :, rotary_dim:]
     )
-    assert torch.equal(out[:, :, 0:2, :, rotary_dim:], qkv_og[:, :, 0:2, :, rotary_dim:])
-    assert torch.equal(out[:, :, 2], qkv_og[:, :, 2])
+    checks.equal("v", out[:, :, 2], qkv_og[:, :, 2])
 
     g = torch.randn_like(out)
     g_og = g.clone().detach()  # Our implementation modifies g inplace
     out.backward(g)
-    q_neox.backward(rearrange(g_og[:, :, 0, :, :rotary_dim], "b s h d -> b h s d"))
-    k_neox.backward(rearrange(g_og[:, :, 1, :, :rotary_dim], "b s h d -> b h s d"))
-    assert torch.allclose(
-        rearrange(q_pt.grad, "b h s d -> b s h d"),
+    q_neox.backward(g_og[:, :, 0, :, :rotary_dim].transpose(1, 2))
+    k_neox.backward(g_og[:, :, 1, :, :rotary_dim].transpose(1, 2))
+    checks.close(
+        "dq",
+        q_pt.grad.transpose(1, 2),
         qkv.grad[:, :, 0, :, :rotary_dim],
         rtol=rtol,
         atol=atol,
     )
-    assert torch.allclose(
-        rearrange(k_pt.grad, "b h s d -> b s h d"),
+    checks.close(
+        "dk",
+        k_pt.grad.transpose(1, 2),
         qkv.grad[:, :, 1, :, :rotary_dim],
         rtol=rtol,
         atol=atol,
     )
-    assert torch.equal(qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:])
-    assert torch.equal(qkv.grad[:, :, 2], g_og[:, :, 2])
+    checks.equal(
+        "dqk pass-through", qkv.grad[:, :, 0:2, :, rotary_dim:], g_og[:, :, 0:2, :, rotary_dim:]
+    )
+    checks.equal("dv", qkv.grad[:, :, 2], g_og[:, :, 2])
+    checks.check()
@@ -103,7 +103,9 @@ def test_rotary_emb_func(inplace, interleaved, rotary_fraction, seqlen_offsets_t
 # @pytest.mark.parametrize('rotary_fraction', [1.0])
 @pytest.mark.parametrize("interleaved", [False, True])
 # @pytest.mark.parametrize('interleaved', [False])
-def test_rotary_emb_qkv(interleaved, rotary_fraction, seqlen_offsets_type, dtype):
+@pytest.mark.parametrize("qkv_contiguous", [True, False])
+# @pytest.mark.parametrize('qkv_contiguous', [True])
+def test_rotary_emb_qkv(qkv_contiguous, interleaved, rotary_fraction, seqlen_offsets_type, dtype):
     rtol = 1e-3
     batch_size = 32
     nheads = 4
@@ -112,9 +114,15 @@ def test_rotary_emb_qkv(interleaved, rotary_fraction, seqlen_offsets_type, dtype
     device = "cuda"
     rotary_dim = int(rotary_fraction * headdim)
     torch.manual_seed(42)
-    qkv = torch.randn(
-        batch_size, seqlen, 3, nheads, headdim, dtype=dtype, device=device, requires_grad=True
-    )
+    if qkv_contiguous:
+        qkv = torch.randn(
+            batch_size, seqlen, 3, nheads, headdim, dtype=dtype, device=device, requires_grad=True
+        )
+    else:
+        qkv = rearrange(
+            torch.randn(batch_size, seqlen, nheads, 3, headdim, dtype=dtype, device=device),
+            "b s h t d -> b s t h d",
+        ).requires_grad_()
     qkv_pt = qkv.detach().clone().requires_grad_()
     cos, sin = generate_cos_sin(seqlen, rotary_dim, device, dtype)
     seqlen_offsets = generate_seqlen_offsets(seqlen_offsets_type, batch_size, seqlen, device)